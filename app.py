@@ -2,12 +2,27 @@
 # SAFE BASELINE app.py (Render + PostgreSQL friendly)
 # ==================================================
 
-from flask import Flask, render_template, request, redirect, session
+from flask import Flask, Request, render_template, request, redirect, session
+import io
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from flask import send_from_directory
+import hashlib
+import tempfile
+import hmac
+import re
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from psycopg import ClientCursor
+from psycopg.rows import namedtuple_row
+from psycopg_pool import ConnectionPool
+from flask import send_from_directory, make_response, abort
+from flask_caching import Cache, make_template_fragment_key
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
+from jinja2 import FileSystemBytecodeCache
 
 
 
@@ -16,6 +31,10 @@ from werkzeug.utils import secure_filename
 DATABASE_URL = os.getenv("DATABASE_URL")
 FLASK_SECRET = os.getenv("FLASK_SECRET", "dev-secret")
 
+# Per-process pool bounds; keep DB_POOL_MAX x workers under the DB's connection limit
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+
 # Fixed single course
 COURSE_ID = 1
 COURSE_TITLE = "Your Course Name"
@@ -25,13 +44,67 @@ COURSE_DESCRIPTION = "Course description"
 RESEND_API_KEY = os.getenv("RESEND_API_KEY")
 FROM_EMAIL = os.getenv("FROM_EMAIL")  # e.g. course@yourdomain.edu
 
+# Let the web server stream downloads instead of a Python worker:
+#   nginx:  X_ACCEL_PREFIX=/_internal_uploads with
+#           location /_internal_uploads/ { internal; alias /app/uploads/; }
+#   Apache: USE_X_SENDFILE=1 with mod_xsendfile enabled
+X_ACCEL_PREFIX = os.getenv("X_ACCEL_PREFIX")
+USE_X_SENDFILE = os.getenv("USE_X_SENDFILE") == "1"
+
+# Number of reverse proxies in front of the app. Set TRUSTED_PROXY_HOPS=1 on
+# Render: X-Forwarded-For from that many hops is then trusted for
+# request.remote_addr. Leave at 0 only when clients reach the app directly;
+# forwarded requests at 0 bypass the per-address login limiter
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
+# Optional cap on request bodies (uploads); unset means no limit
+MAX_UPLOAD_BYTES = os.getenv("MAX_UPLOAD_BYTES")
+
 
 # ---------------- APP ----------------
 
+class UploadRequest(Request):
+    # Spool large multipart file parts on the uploads volume rather than
+    # /tmp, which is often RAM-backed in containers
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= 500 * 1024:
+            return io.BytesIO()
+        return tempfile.TemporaryFile("rb+", dir=UPLOAD_FOLDER)
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
 app.secret_key = FLASK_SECRET
-
-UPLOAD_FOLDER = os.path.join(app.root_path, "uploads")
+app.use_x_sendfile = USE_X_SENDFILE
+if MAX_UPLOAD_BYTES:
+    app.config["MAX_CONTENT_LENGTH"] = int(MAX_UPLOAD_BYTES)
+
+# Compiled templates are kept on disk across worker restarts (auto-reload
+# already follows app.debug, so production renders don't stat templates)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+# Cache for read-mostly query results and rendered fragments; writers
+# invalidate. SimpleCache is per process, so an invalidation only reaches
+# the worker that made the change: use it for a single worker only, and set
+# CACHE_TYPE=RedisCache + CACHE_REDIS_URL (needs the redis package) when
+# running several gunicorn workers
+CACHE_TYPE = os.getenv("CACHE_TYPE", "SimpleCache")
+cache = Cache(app, config={
+    "CACHE_TYPE": CACHE_TYPE,
+    "CACHE_REDIS_URL": os.getenv("CACHE_REDIS_URL"),
+    "CACHE_DEFAULT_TIMEOUT": 60,
+})
+
+# With a shared backend every worker sees invalidations, so entries can
+# live long; per-process entries are kept short to bound staleness on
+# workers that missed the invalidation
+COURSE_CACHE_TIMEOUT = 5 if CACHE_TYPE == "SimpleCache" else 300
+STUDENT_EMAILS_CACHE_TIMEOUT = 5 if CACHE_TYPE == "SimpleCache" else 3600
+
+# Resolved once (symlinks included) so per-request joins start from a canonical path
+UPLOAD_FOLDER = os.path.realpath(os.path.join(app.root_path, "uploads"))
 LECTURE_FOLDER = os.path.join(UPLOAD_FOLDER, "lectures")
 ASSIGNMENT_FOLDER = os.path.join(UPLOAD_FOLDER, "assignments")
 
@@ -41,22 +114,102 @@ os.makedirs(ASSIGNMENT_FOLDER, exist_ok=True)
 
 # ---------------- DATABASE ----------------
 
-def get_db():
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL not set")
-
-    return psycopg2.connect(
+if not DATABASE_URL:
+    raise RuntimeError("DATABASE_URL not set")
+
+# Hot lookups, prepared server-side once per connection by psycopg
+PREPARED_STATEMENTS = {
+    # Lectures and assignments in one round trip, tagged by kind; only the
+    # fields course_page.html renders are shipped
+    "course_payload": """
+        SELECT 'l' AS kind, l.id,
+               json_build_object('title', l.title, 'filename', l.filename,
+                                 'original_name', l.original_name) AS j
+        FROM lectures l WHERE l.course_id=%(course_id)s
+        UNION ALL
+        SELECT 'a', a.id,
+               json_build_object('title', a.title, 'filename', a.filename,
+                                 'original_name', a.original_name, 'due_date', a.due_date)
+        FROM assignments a WHERE a.course_id=%(course_id)s
+        ORDER BY kind, id DESC
+    """,
+    # Thread plus its replies (aggregated to JSON) in one round trip;
+    # created_at is cast to text so replies render like the thread's timestamp
+    "discussion_page": """
+        SELECT d.id, d.author_name, d.title, d.content, d.created_at,
+               COALESCE((
+                   SELECT json_agg(json_build_object(
+                              'author_name', r.author_name,
+                              'content', r.content,
+                              'created_at', r.created_at::text
+                          ) ORDER BY r.created_at)
+                   FROM discussion_replies r WHERE r.discussion_id = d.id
+               ), '[]') AS replies
+        FROM discussions d WHERE d.id=%(discussion_id)s
+    """,
+}
+
+
+def make_pool():
+    return ConnectionPool(
         DATABASE_URL,
-        cursor_factory=RealDictCursor,
-        connect_timeout=5
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        kwargs={"connect_timeout": 5},
+        open=False,
     )
 
 
-def init_db():
-    conn = get_db()
-    cur = conn.cursor()
+# One pool per process, so TCP + TLS + auth is paid once, not per request
+POOL = make_pool()
+POOL_PID = None
+POOL_LOCK = threading.Lock()
+
 
-    cur.execute("""
+def open_pool():
+    # Sockets and the pool's worker threads don't survive fork, so a process
+    # never uses a pool opened by its parent (gunicorn --preload): the first
+    # call in each process opens its own, blocking until min_size connections
+    # are up so the first requests don't pay for connect
+    global POOL, POOL_PID
+    pid = os.getpid()
+    if POOL_PID == pid:
+        return
+
+    with POOL_LOCK:
+        if POOL_PID == pid:
+            return
+        if POOL_PID is not None:
+            POOL = make_pool()
+        POOL.open()
+        POOL.wait()
+        POOL_PID = pid
+
+
+@contextmanager
+def get_db():
+    # Commits on clean exit, rolls back on error, then returns conn to the pool
+    open_pool()
+    with POOL.connection() as conn:
+        yield conn
+
+
+@contextmanager
+def db_cursor(row_factory=None):
+    with get_db() as conn:
+        cur = conn.cursor(row_factory=row_factory) if row_factory else conn.cursor()
+        with cur:
+            yield cur
+
+
+def execute_prepared(cur, name, params):
+    # prepare=True plans the statement once per connection; binary results
+    # skip text formatting on the server and parsing on the client
+    cur.execute(PREPARED_STATEMENTS[name], params, prepare=True, binary=True)
+
+
+SCHEMA_STATEMENTS = [
+    """
     CREATE TABLE IF NOT EXISTS discussions (
         id SERIAL PRIMARY KEY,
         author_name TEXT,
@@ -64,10 +217,9 @@ def init_db():
         title TEXT,
         content TEXT,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-
-    cur.execute("""
+    )
+    """,
+    """
     CREATE TABLE IF NOT EXISTS discussion_replies (
         id SERIAL PRIMARY KEY,
         discussion_id INTEGER REFERENCES discussions(id) ON DELETE CASCADE,
@@ -75,61 +227,89 @@ def init_db():
         author_email TEXT,
         content TEXT,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS courses (
-            id INTEGER PRIMARY KEY,
-            title TEXT,
-            instructor TEXT,
-            description TEXT
-        );
-    """)
-
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS students (
-            id SERIAL PRIMARY KEY,
-            name TEXT,
-            email TEXT UNIQUE
-        );
-    """)
-
-    cur.execute("""
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS courses (
+        id INTEGER PRIMARY KEY,
+        title TEXT,
+        instructor TEXT,
+        description TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS students (
+        id SERIAL PRIMARY KEY,
+        name TEXT,
+        email TEXT UNIQUE
+    )
+    """,
+    """
     CREATE TABLE IF NOT EXISTS lectures (
         id SERIAL PRIMARY KEY,
         title TEXT,
         filename TEXT,
+        original_name TEXT,
         course_id INTEGER
-    );
-    """)
-
-    cur.execute("""
+    )
+    """,
+    """
     CREATE TABLE IF NOT EXISTS assignments (
         id SERIAL PRIMARY KEY,
         title TEXT,
         filename TEXT,
+        original_name TEXT,
         due_date TEXT,
         course_id INTEGER
-    );
-    """)
+    )
+    """,
+
+    # filename is the content-addressed name on disk; original_name is the
+    # (secured) name it was uploaded under, carried in download links
+    "ALTER TABLE lectures ADD COLUMN IF NOT EXISTS original_name TEXT",
+    "ALTER TABLE assignments ADD COLUMN IF NOT EXISTS original_name TEXT",
+
+    # Composite (filter, sort) indexes for the hot list queries: lookups by
+    # course / thread are index scans, and the discussion queries read rows
+    # already in order. course_payload still sorts its merged UNION ALL
+    # result at the top level, but only over the rows for one course
+    "CREATE INDEX IF NOT EXISTS ix_lectures_course_id_desc ON lectures(course_id, id DESC)",
+    "CREATE INDEX IF NOT EXISTS ix_assignments_course_id_desc ON assignments(course_id, id DESC)",
+    "CREATE INDEX IF NOT EXISTS ix_discussion_replies_discussion_created "
+    "ON discussion_replies(discussion_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_discussions_created_desc ON discussions(created_at DESC)",
 
     # Ensure fixed course exists / updates
-    cur.execute(
-        """
-        INSERT INTO courses (id, title, instructor, description)
-        VALUES (%s,%s,%s,%s)
-        ON CONFLICT (id) DO UPDATE SET
-            title = EXCLUDED.title,
-            instructor = EXCLUDED.instructor,
-            description = EXCLUDED.description
-        """,
-        (COURSE_ID, COURSE_TITLE, COURSE_INSTRUCTOR, COURSE_DESCRIPTION)
-    )
+    """
+    INSERT INTO courses (id, title, instructor, description)
+    VALUES (%s,%s,%s,%s)
+    ON CONFLICT (id) DO UPDATE SET
+        title = EXCLUDED.title,
+        instructor = EXCLUDED.instructor,
+        description = EXCLUDED.description
+    """,
+]
+
+# Sent as a single multi-statement query: one round trip at startup.
+# Server-side binding rejects multiple statements, hence ClientCursor
+SCHEMA_SQL = ";\n".join(SCHEMA_STATEMENTS)
 
-    conn.commit()
-    cur.close()
-    conn.close()
+
+DB_INITIALIZED = False
+
+
+def init_db():
+    # Schema setup runs at most once per process
+    global DB_INITIALIZED
+    if DB_INITIALIZED:
+        return
+
+    with get_db() as conn, ClientCursor(conn) as cur:
+        cur.execute(
+            SCHEMA_SQL,
+            (COURSE_ID, COURSE_TITLE, COURSE_INSTRUCTOR, COURSE_DESCRIPTION)
+        )
+    DB_INITIALIZED = True
 
 
 with app.app_context():
@@ -137,15 +317,20 @@ with app.app_context():
 
 # ---------------- CONTEXT ----------------
 
+# The fixed course never changes at runtime (init_db upserts these same
+# constants), so the template context is built once and shared
+STATIC_CONTEXT = {
+    "course": {
+        "title": COURSE_TITLE,
+        "instructor": COURSE_INSTRUCTOR,
+        "description": COURSE_DESCRIPTION,
+    }
+}
+
+
 @app.context_processor
 def inject_course():
-    return {
-        "course": {
-            "title": COURSE_TITLE,
-            "instructor": COURSE_INSTRUCTOR,
-            "description": COURSE_DESCRIPTION,
-        }
-    }
+    return STATIC_CONTEXT
 
 # ---------------- ROUTES ----------------
 
@@ -154,54 +339,78 @@ def index():
     return redirect("/course")
 
 
-@app.route("/course")
-def course_page():
-    conn = get_db()
-    cur = conn.cursor()
+@cache.memoize(COURSE_CACHE_TIMEOUT)
+def load_course_payload(course_id):
+    with db_cursor() as cur:
+        execute_prepared(cur, "course_payload", {"course_id": course_id})
+        rows = cur.fetchall()
 
-    cur.execute("SELECT * FROM courses WHERE id=%s", (COURSE_ID,))
-    course = cur.fetchone()
+    lectures = []
+    assignments = []
+    for kind, _, data in rows:
+        if kind == "l":
+            lectures.append(data)
+        else:
+            assignments.append(data)
 
-    cur.execute("SELECT * FROM lectures WHERE course_id=%s ORDER BY id DESC", (COURSE_ID,))
-    lectures = cur.fetchall()
+    return lectures, assignments
+
+
+def invalidate_course_cache():
+    # Drop the memoized query result and the rendered course_page.html fragments
+    cache.delete_memoized(load_course_payload, COURSE_ID)
+    cache.delete_many(
+        make_template_fragment_key("course_lectures"),
+        make_template_fragment_key("course_assignments"),
+    )
 
-    cur.close()
-    conn.close()
 
-    if not course:
-        return "Course not found", 500
+@app.route("/course")
+def course_page():
+    lectures, assignments = load_course_payload(COURSE_ID)
 
     return render_template(
         "course_page.html",
-        course=course,
         lectures=lectures,
+        assignments=assignments,
+        course_cache_timeout=COURSE_CACHE_TIMEOUT,
     )
 
 
+# Basic shape check; the browser's type="email" is not enforced server-side
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+
 @app.route("/student/register", methods=["GET", "POST"])
 def student_register():
     if request.method == "POST":
         name = request.form["name"]
-        email = request.form["email"]
+        email = request.form["email"].strip()
 
-        conn = get_db()
-        cur = conn.cursor()
+        if not EMAIL_RE.match(email):
+            return "Invalid email address", 400
 
-        cur.execute("SELECT 1 FROM students WHERE email=%s", (email,))
-        if not cur.fetchone():
+        # Dedupe + insert in one statement; a row comes back only if new
+        with db_cursor() as cur:
             cur.execute(
-                "INSERT INTO students (name, email) VALUES (%s,%s)",
+                """
+                INSERT INTO students (name, email) VALUES (%s,%s)
+                ON CONFLICT (email) DO NOTHING
+                RETURNING email
+                """,
                 (name, email)
             )
-            send_email(
+            inserted = cur.fetchone()
+
+        if inserted:
+            cache.delete_memoized(get_student_emails)
+            EMAIL_EXECUTOR.submit(
+                send_email,
                 email,
                 "Registration confirmed",
                 f"You’ll now receive updates for {COURSE_TITLE}."
             )
-            conn.commit()
 
-        cur.close()
-        conn.close()
         return redirect("/course")
 
     return render_template("student_register.html")
@@ -210,8 +419,8 @@ def student_register():
 @app.route("/health")
 def health():
     try:
-        conn = get_db()
-        conn.close()
+        with db_cursor() as cur:
+            cur.execute("SELECT 1")
         return "OK"
     except Exception as e:
         return str(e), 500
@@ -222,33 +431,182 @@ def health():
 # ===============================
 
 from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 
 INSTRUCTOR_USERNAME = os.getenv("INSTRUCTOR_USERNAME")
+# Preferably an argon2 hash: python -c "from argon2 import PasswordHasher; print(PasswordHasher().hash('...'))"
+# Werkzeug generate_password_hash values are still accepted
 INSTRUCTOR_PASSWORD_HASH = os.getenv("INSTRUCTOR_PASSWORD_HASH")
 
+PASSWORD_HASHER = PasswordHasher()
+
+
+def check_hash(pw_hash, password):
+    if pw_hash.startswith("$argon2"):
+        try:
+            return PASSWORD_HASHER.verify(pw_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    return check_password_hash(pw_hash, password)
+
+
+# The KDF is deliberately slow, so repeat logins with correct credentials
+# skip it. Only successes are remembered, and only as an HMAC under a
+# per-process random key: no plaintext and no wrong guesses stay in memory.
+# Callers pass remember=False unless the username already matched, so a
+# fast answer never confirms a password paired with a wrong username
+VERIFIED_KEY = os.urandom(32)
+VERIFIED = set()
+VERIFIED_MAX = 256
+
+
+def verify_password(pw_hash, password, remember=True):
+    if not remember:
+        return check_hash(pw_hash, password)
+
+    token = hmac.new(
+        VERIFIED_KEY, f"{pw_hash}\0{password}".encode("utf-8"), hashlib.sha256
+    ).digest()
+    if token in VERIFIED:
+        return True
+
+    ok = check_hash(pw_hash, password)
+    if ok:
+        if len(VERIFIED) >= VERIFIED_MAX:
+            VERIFIED.clear()
+        VERIFIED.add(token)
+    return ok
+
+
+# After this many failed attempts within a minute, a client address gets
+# 429 before any KDF runs. Behind a proxy this needs TRUSTED_PROXY_HOPS,
+# otherwise every client shares the proxy's address
+LOGIN_FAILURES_PER_MINUTE = 3
+
+
+def login_attempts_key():
+    # A forwarded request with TRUSTED_PROXY_HOPS unset means remote_addr is
+    # the proxy, so limiting on it would let anyone lock out the instructor.
+    # Skip the limiter rather than key it on an address shared by everyone
+    if not TRUSTED_PROXY_HOPS and request.headers.get("X-Forwarded-For"):
+        return None
+    return f"login_failures:{request.remote_addr}"
+
+
+def login_rate_limited():
+    key = login_attempts_key()
+    return key is not None and (cache.get(key) or 0) >= LOGIN_FAILURES_PER_MINUTE
+
+
+def record_login_failure():
+    key = login_attempts_key()
+    if key is not None:
+        cache.set(key, (cache.get(key) or 0) + 1, timeout=60)
+
+
+def clear_login_failures():
+    key = login_attempts_key()
+    if key is not None:
+        cache.delete(key)
+
+
 @app.route("/login", methods=["GET", "POST"])
 def instructor_login():
     if request.method == "POST":
         if not INSTRUCTOR_USERNAME or not INSTRUCTOR_PASSWORD_HASH:
             return "Instructor credentials not configured", 500
 
-        username = request.form.get("username")
-        password = request.form.get("password")
+        if login_rate_limited():
+            return "Too many login attempts, try again in a minute", 429
+
+        username = request.form.get("username", "")
+        password = request.form.get("password", "")
 
-        if username == INSTRUCTOR_USERNAME and check_password_hash(INSTRUCTOR_PASSWORD_HASH, password):
+        # Bytes, since compare_digest rejects non-ASCII str input. The
+        # password is always checked, but the remembered-success shortcut only
+        # applies once the username matched: with a wrong username the full
+        # KDF runs, so timing can't confirm the password on its own
+        user_ok = hmac.compare_digest(username.encode("utf-8"), INSTRUCTOR_USERNAME.encode("utf-8"))
+        pw_ok = verify_password(INSTRUCTOR_PASSWORD_HASH, password, remember=user_ok)
+        if user_ok and pw_ok:
+            clear_login_failures()
             session["instructor"] = True
             return redirect("/course")
 
+        record_login_failure()
         return "Invalid credentials", 401
 
     return render_template("login.html")
 
 
+# ---------------- UPLOADS ----------------
 
+# Uploads are copied to disk in chunks of this size, so memory use
+# stays flat no matter how large the upload is
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
-UPLOAD_FOLDER = "uploads"
-LECTURE_FOLDER = os.path.join(UPLOAD_FOLDER, "lectures")
-os.makedirs(LECTURE_FOLDER, exist_ok=True)
+
+def store_upload(stream, folder, filename):
+    # Content-addressed: the file is stored as <blake2b of bytes><ext>, so
+    # re-uploading identical content reuses the file already on disk
+    digest = hashlib.blake2b(digest_size=16)
+    tmp = tempfile.NamedTemporaryFile(dir=folder, delete=False)
+    try:
+        with tmp:
+            for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                tmp.write(chunk)
+
+        stored = digest.hexdigest() + os.path.splitext(filename)[1].lower()
+        try:
+            os.link(tmp.name, os.path.join(folder, stored))
+        except FileExistsError:
+            pass
+    finally:
+        os.unlink(tmp.name)
+
+    return stored
+
+
+def upload_filename():
+    # Raw uploads carry the original name as ?filename= (URL-encoded, so any
+    # character survives; headers are limited to latin-1)
+    return secure_filename(request.args.get("filename", ""))
+
+
+def record_lecture(title, filename, original_name):
+    with db_cursor() as cur:
+        cur.execute(
+            "INSERT INTO lectures (title, filename, original_name, course_id) VALUES (%s,%s,%s,%s)",
+            (title, filename, original_name, COURSE_ID)
+        )
+    invalidate_course_cache()
+
+    EMAIL_EXECUTOR.submit(
+        broadcast,
+        get_student_emails(),
+        "New lecture uploaded",
+        f"A new lecture has been added to {COURSE_TITLE}.\n\nPlease visit the course page to download it."
+    )
+
+
+def record_assignment(title, filename, original_name, due_date):
+    with db_cursor() as cur:
+        cur.execute(
+            "INSERT INTO assignments (title, filename, original_name, due_date, course_id) "
+            "VALUES (%s,%s,%s,%s,%s)",
+            (title, filename, original_name, due_date, COURSE_ID)
+        )
+    invalidate_course_cache()
+
+    # 🔔 Email notification (final step)
+    EMAIL_EXECUTOR.submit(
+        broadcast,
+        get_student_emails(),
+        "New assignment posted",
+        f"A new assignment has been posted for {COURSE_TITLE}.\n\nPlease check the course page for details."
+    )
 
 
 
@@ -266,31 +624,36 @@ def add_lecture():
         if not file or file.filename == "":
             return "No file selected", 400
 
-        filename = secure_filename(file.filename)
-        save_path = os.path.join(LECTURE_FOLDER, filename)
-        file.save(save_path)
+        original_name = secure_filename(file.filename)
+        filename = store_upload(file.stream, LECTURE_FOLDER, original_name)
 
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO lectures (title, filename, course_id) VALUES (%s,%s,%s)",
-            (title, filename, COURSE_ID)
-        )
-        conn.commit()
-        for email in get_student_emails():
-            send_email(
-                email,
-                "New lecture uploaded",
-                f"A new lecture has been added to {COURSE_TITLE}.\n\nPlease visit the course page to download it."
-            )
-        cur.close()
-        conn.close()
+        record_lecture(title, filename, original_name)
 
         return redirect("/course")
 
     return render_template("add_lecture.html")
 
 
+@app.route("/upload/lecture", methods=["PUT"])
+def upload_lecture():
+    if not session.get("instructor"):
+        return "Unauthorized", 403
+
+    # Title travels as a query parameter: in a path segment an encoded "/"
+    # is decoded before routing and the request 404s
+    title = request.args.get("title", "")
+    filename = upload_filename()
+    if not title:
+        return "Missing title", 400
+    if not filename or not request.content_length:
+        return "No file selected", 400
+
+    stored = store_upload(request.stream, LECTURE_FOLDER, filename)
+    record_lecture(title, stored, filename)
+
+    return "Uploaded", 201
+
+
 @app.route("/add_assignment", methods=["GET", "POST"])
 def add_assignment():
     if not session.get("instructor"):
@@ -304,51 +667,61 @@ def add_assignment():
         if not file or file.filename == "":
             return "No file selected", 400
 
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(ASSIGNMENT_FOLDER, filename))
+        original_name = secure_filename(file.filename)
+        filename = store_upload(file.stream, ASSIGNMENT_FOLDER, original_name)
 
-        conn = get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO assignments (title, filename, due_date, course_id) VALUES (%s,%s,%s,%s)",
-            (title, filename, due_date, COURSE_ID)
-        )
-        conn.commit()
+        record_assignment(title, filename, original_name, due_date)
 
-        for email in get_student_emails():
-            send_email(
-                email,
-                "New assignment posted",
-                f"A new assignment has been posted for {COURSE_TITLE}.\n\nPlease check the course page for details."
-            )
+        return redirect("/course")
 
-        cur.close()
-        conn.close()
+    return render_template("add_assignment.html")
 
-        # 🔔 Email notification (final step)
-        for email in get_student_emails():
-            send_email(
-                email,
-                "New assignment posted",
-                f"A new assignment has been posted for {COURSE_TITLE}.\n\nPlease check the course page."
-            )
 
-        return redirect("/course")
+@app.route("/upload/assignment", methods=["PUT"])
+def upload_assignment():
+    if not session.get("instructor"):
+        return "Unauthorized", 403
 
-    return render_template("add_assignment.html")
+    title = request.args.get("title", "")
+    due_date = request.args.get("due_date", "")
+    filename = upload_filename()
+    if not title:
+        return "Missing title", 400
+    if not filename or not request.content_length:
+        return "No file selected", 400
+
+    stored = store_upload(request.stream, ASSIGNMENT_FOLDER, filename)
+    record_assignment(title, stored, filename, due_date)
+
+    return "Uploaded", 201
+
+
+def send_upload(folder, kind, filename):
+    # The row's original name rides along in the link (?name=), so identical
+    # uploads shared on disk still download under their own names. Links from
+    # rows that predate original_name fall back to the stored name
+    name = secure_filename(request.args.get("name", "")) or filename
+
+    if not X_ACCEL_PREFIX:
+        return send_from_directory(folder, filename, as_attachment=True, download_name=name)
+
+    # Stored names always went through secure_filename; reject anything else
+    if secure_filename(filename) != filename:
+        abort(404)
+
+    resp = make_response("")
+    resp.headers["X-Accel-Redirect"] = f"{X_ACCEL_PREFIX}/{kind}/{filename}"
+    resp.headers["Content-Disposition"] = f'attachment; filename="{name}"'
+    return resp
 
 
 @app.route("/download/lecture/<filename>")
 def download_lecture(filename):
-    return send_from_directory(LECTURE_FOLDER, filename, as_attachment=True)
+    return send_upload(LECTURE_FOLDER, "lectures", filename)
 
 @app.route("/download/assignment/<filename>")
 def download_assignment(filename):
-    return send_from_directory(
-        ASSIGNMENT_FOLDER,
-        filename,
-        as_attachment=True
-    )
+    return send_upload(ASSIGNMENT_FOLDER, "assignments", filename)
 
 
 
@@ -363,26 +736,37 @@ def clear_lectures():
     if not session.get("instructor"):
         return "Unauthorized", 403
 
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM lectures")
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute("DELETE FROM lectures")
+    invalidate_course_cache()
     return "Lectures cleared"
 
+# Emails go out on background threads so requests don't wait on Resend;
+# the shared session keeps the TLS connection to api.resend.com warm
+EMAIL_WORKERS = 8
+EMAIL_EXECUTOR = ThreadPoolExecutor(max_workers=EMAIL_WORKERS)
+EMAIL_SESSION = requests.Session()
+# One kept-alive connection per sender thread; Retry's defaults don't
+# resend POSTs after a read error, so only failed connects are retried
+EMAIL_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=EMAIL_WORKERS,
+    max_retries=Retry(total=2, backoff_factor=0.2),
+))
+EMAIL_SESSION.headers.update({
+    "Authorization": f"Bearer {RESEND_API_KEY}",
+    "Content-Type": "application/json",
+})
+
+
 def send_email(to_email, subject, body):
     if not RESEND_API_KEY or not FROM_EMAIL:
         print("Email disabled (missing config)")
         return
 
     try:
-        r = requests.post(
+        r = EMAIL_SESSION.post(
             "https://api.resend.com/emails",
-            headers={
-                "Authorization": f"Bearer {RESEND_API_KEY}",
-                "Content-Type": "application/json",
-            },
             json={
                 "from": FROM_EMAIL,
                 "to": to_email,
@@ -400,43 +784,72 @@ def send_email(to_email, subject, body):
         print("Email exception:", e)
 
 
-@app.route("/discussions")
-def discussions():
-    conn = get_db()
-    cur = conn.cursor()
+# Resend's /emails/batch accepts at most this many messages per request
+RESEND_BATCH_SIZE = 100
 
-    cur.execute("""
-        SELECT * FROM discussions
-        ORDER BY created_at DESC
-    """)
-    threads = cur.fetchall()
 
-    cur.close()
-    conn.close()
+def send_email_batch(messages):
+    if not RESEND_API_KEY or not FROM_EMAIL:
+        print("Email disabled (missing config)")
+        return
+
+    try:
+        # Permissive mode: an invalid recipient fails only its own message
+        # instead of rejecting the whole batch
+        r = EMAIL_SESSION.post(
+            "https://api.resend.com/emails/batch",
+            headers={"x-batch-validation": "permissive"},
+            json=messages,
+            timeout=10,
+        )
+
+        if r.status_code >= 400:
+            print("Email error:", r.text)
+        else:
+            for err in r.json().get("errors") or []:
+                print("Email error:", err)
+
+    except Exception as e:
+        # CRITICAL: never crash the caller
+        print("Email exception:", e)
+
+
+def broadcast(emails, subject, body):
+    messages = [
+        {"from": FROM_EMAIL, "to": email, "subject": subject, "text": body}
+        for email in emails
+    ]
+    for i in range(0, len(messages), RESEND_BATCH_SIZE):
+        send_email_batch(messages[i:i + RESEND_BATCH_SIZE])
+
+
+@app.route("/discussions")
+def discussions():
+    with db_cursor(namedtuple_row) as cur:
+        cur.execute("""
+            SELECT id, title, author_name, created_at FROM discussions
+            ORDER BY created_at DESC
+        """)
+        threads = cur.fetchall()
 
     return render_template("discussions.html", threads=threads)
 
 @app.route("/discussions/new", methods=["GET", "POST"])
 def new_discussion():
     if request.method == "POST":
-        conn = get_db()
-        cur = conn.cursor()
-
-        cur.execute(
-            """
-            INSERT INTO discussions (author_name, author_email, title, content)
-            VALUES (%s,%s,%s,%s)
-            """,
-            (
-                request.form["name"],
-                request.form["email"],
-                request.form["title"],
-                request.form["content"],
-            ),
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO discussions (author_name, author_email, title, content)
+                VALUES (%s,%s,%s,%s)
+                """,
+                (
+                    request.form["name"],
+                    request.form["email"],
+                    request.form["title"],
+                    request.form["content"],
+                ),
+            )
 
         return redirect("/discussions")
 
@@ -444,24 +857,9 @@ def new_discussion():
 
 @app.route("/discussions/<int:discussion_id>")
 def view_discussion(discussion_id):
-    conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute("SELECT * FROM discussions WHERE id=%s", (discussion_id,))
-    thread = cur.fetchone()
-
-    cur.execute(
-        """
-        SELECT * FROM discussion_replies
-        WHERE discussion_id=%s
-        ORDER BY created_at
-        """,
-        (discussion_id,),
-    )
-    replies = cur.fetchall()
-
-    cur.close()
-    conn.close()
+    with db_cursor(namedtuple_row) as cur:
+        execute_prepared(cur, "discussion_page", {"discussion_id": discussion_id})
+        thread = cur.fetchone()
 
     if not thread:
         return "Discussion not found", 404
@@ -469,44 +867,35 @@ def view_discussion(discussion_id):
     return render_template(
         "discussion_thread.html",
         thread=thread,
-        replies=replies,
+        replies=thread.replies,
     )
 @app.route("/discussions/<int:discussion_id>/reply", methods=["POST"])
 def reply_discussion(discussion_id):
-    conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-        INSERT INTO discussion_replies
-        (discussion_id, author_name, author_email, content)
-        VALUES (%s,%s,%s,%s)
-        """,
-        (
-            discussion_id,
-            request.form["name"],
-            request.form["email"],
-            request.form["content"],
-        ),
-    )
-
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO discussion_replies
+            (discussion_id, author_name, author_email, content)
+            VALUES (%s,%s,%s,%s)
+            """,
+            (
+                discussion_id,
+                request.form["name"],
+                request.form["email"],
+                request.form["content"],
+            ),
+        )
 
     return redirect(f"/discussions/{discussion_id}")
 
 
-
+# Read on every upload broadcast; registration invalidates it
+@cache.memoize(STUDENT_EMAILS_CACHE_TIMEOUT)
 def get_student_emails():
-    conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute("SELECT email FROM students")
-    emails = [row["email"] for row in cur.fetchall()]
+    with db_cursor() as cur:
+        cur.execute("SELECT email FROM students", binary=True)
+        emails = [email for (email,) in cur.fetchall()]
 
-    cur.close()
-    conn.close()
     return emails
 
 
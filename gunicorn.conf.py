@@ -0,0 +1,9 @@
+# Picked up automatically when gunicorn starts from the repo root
+
+
+def post_worker_init(worker):
+    # Each worker opens its own DB pool before taking requests; with
+    # --preload the app was imported in the master, whose pool can't be
+    # shared across the fork
+    from app import open_pool
+    open_pool()